@@ -59,9 +59,11 @@ fi
 step "systemd daemon-reload"
 systemctl daemon-reload
 
-step "Restart ingest-api and ingest-worker"
-systemctl restart ingest-api
+# Worker first: a new worker reads both stream entry formats, an old one can't read
+# entries from a new API (they would stay pending and unacked)
+step "Restart ingest-worker and ingest-api"
 systemctl restart ingest-worker
+systemctl restart ingest-api
 
 ### ===== 5) Health check via nginx (8443) =====
 step "Health check"
@@ -3,7 +3,11 @@ from dotenv import load_dotenv
 from urllib.parse import quote_plus
 from typing import Optional
 
-load_dotenv()
+# Values are read once at import and kept as module constants. Child processes
+# (e.g. uvicorn workers) inherit the loaded environment, so skip re-reading .env there.
+if not os.environ.get("_DOTENV_LOADED"):
+    load_dotenv()
+    os.environ["_DOTENV_LOADED"] = "1"
 
 APP_HOST = os.getenv("APP_HOST", "127.0.0.1")
 APP_PORT = int(os.getenv("APP_PORT", 8000))
@@ -30,7 +34,8 @@ SCHEMA_VERSION = 1
 APP_VERSION = "0.1.0"
 STREAM_KEY = "ingest.v1"
 CONSUMER_GROUP = "ingest_workers"
+ENQUEUE_COALESCE_MAX = 64  # XADDs per pipelined flush
+ENQUEUE_COALESCE_WINDOW = 0.001  # seconds to wait for more batches before flushing
 MAX_ITEMS = 100
 MIN_ITEMS = 1
 MAX_BODY_SIZE = 5 * 1024 * 1024  # 5 MB
-ALLOWED_PROTOCOLS = {"rps", "pms", "css", "dss"}
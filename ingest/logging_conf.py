@@ -1,14 +1,21 @@
+import atexit
 import logging
 import sys
 import os
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 from datetime import datetime
+import orjson
 import structlog
 from structlog.stdlib import BoundLogger
 import colorama
 from colorama import Fore, Style
 from ingest.config import LOG_LEVEL
 
-colorama.init()
+# Colour only for interactive terminals; under systemd/journald stdout is not a tty
+_console_is_tty = sys.stdout.isatty()
+if _console_is_tty:
+    colorama.init()
 
 # Custom log levels (added below standard NOTSET=0)
 logging.TRACE = 5
@@ -37,6 +44,10 @@ def debug3(self, msg, *args, **kw):
     self._log(logging.DEBUG3, msg, args, **kw)
 logging.Logger.debug3 = debug3
 
+def _orjson_dumps(obj, **kw) -> str:
+    """orjson-backed serializer for JSONRenderer; handlers expect str, not bytes."""
+    return orjson.dumps(obj, **kw).decode()
+
 class ColoredJSONFormatter(structlog.processors.JSONRenderer):
     """Custom JSON formatter with colors for console."""
     color_map = {
@@ -57,6 +68,17 @@ class ColoredJSONFormatter(structlog.processors.JSONRenderer):
         color = self.color_map.get(level, '')
         return color + json_str + Style.RESET_ALL
 
+# Frame walking is too costly for every request log; keep func_name for errors only
+_callsite_adder = structlog.processors.CallsiteParameterAdder(
+    {structlog.processors.CallsiteParameter.FUNC_NAME},
+    additional_ignores=[__name__],
+)
+
+def add_callsite_on_error(logger, method_name, event_dict):
+    if event_dict.get("level") in ("error", "critical"):
+        return _callsite_adder(logger, method_name, event_dict)
+    return event_dict
+
 # Log file setup
 log_dir = "logs"
 if not os.path.exists(log_dir):
@@ -66,13 +88,14 @@ log_file = os.path.join(log_dir, f"{datetime.now().isoformat()}.log")
 # Stdlib handlers
 file_handler = logging.FileHandler(log_file)
 file_handler.setFormatter(structlog.stdlib.ProcessorFormatter(
-    processor=structlog.processors.JSONRenderer(),
+    processor=structlog.processors.JSONRenderer(serializer=_orjson_dumps),
 ))
 file_handler.setLevel(logging.TRACE)  # File always logs everything >= TRACE
 
 console_handler = logging.StreamHandler(sys.stdout)
+console_renderer = ColoredJSONFormatter if _console_is_tty else structlog.processors.JSONRenderer
 console_handler.setFormatter(structlog.stdlib.ProcessorFormatter(
-    processor=ColoredJSONFormatter(),
+    processor=console_renderer(serializer=_orjson_dumps),
 ))
 console_level = getattr(logging, LOG_LEVEL.upper(), logging.INFO)
 console_handler.setLevel(console_level)
@@ -84,9 +107,7 @@ structlog.configure(
         structlog.processors.TimeStamper(fmt="iso", utc=True),
         structlog.stdlib.add_log_level,
         structlog.stdlib.add_logger_name,
-        structlog.processors.CallsiteParameterAdder({
-            structlog.processors.CallsiteParameter.FUNC_NAME,
-        }),
+        add_callsite_on_error,
         structlog.stdlib.PositionalArgumentsFormatter(),
         structlog.processors.StackInfoRenderer(),
         structlog.processors.format_exc_info,
@@ -98,7 +119,22 @@ structlog.configure(
     cache_logger_on_first_use=True,
 )
 
+class StructlogQueueHandler(QueueHandler):
+    """QueueHandler that enqueues records untouched.
+
+    The default prepare() pre-formats record.msg into a string, which would hide
+    structlog's event dict from the ProcessorFormatter on the real handlers.
+    """
+    def prepare(self, record):
+        return record
+
+# File/console I/O runs on the listener thread; logging calls only enqueue
+log_queue = SimpleQueue()
+queue_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+queue_listener.start()
+atexit.register(queue_listener.stop)
+
 # Root logger setup
-logging.basicConfig(handlers=[file_handler, console_handler], level=console_level)
+logging.basicConfig(handlers=[StructlogQueueHandler(log_queue)], level=console_level)
 
 logger: BoundLogger = structlog.get_logger()
@@ -1,27 +1,44 @@
-import uuid
-from datetime import datetime
-from typing import Optional
-import gzip
-import orjson
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from time import perf_counter_ns
+from typing import Dict, List, Optional
+try:
+    # Intel ISA-L inflate is 2-4x faster on large bodies; same API as zlib
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
 from fastapi import FastAPI, Request, HTTPException, status
 from fastapi.responses import ORJSONResponse
 from pydantic import ValidationError
-from ingest.schemas import IngestRequest, TestRequest, HealthResponse, IngestResponse, TestResponse, ErrorDetail, Item
+from pydantic_core import from_json
+from ingest.schemas import IngestRequest, TestRequest, HealthResponse, IngestResponse, TestResponse, ErrorDetail, ITEMS_ADAPTER
 from ingest.config import APP_VERSION, SCHEMA_VERSION, MAX_BODY_SIZE, APP_HOST, APP_PORT
-from ingest.queue import enqueue_batch
+from ingest.queue import enqueue_batch, close_redis
 from ingest.logging_conf import logger
 
-app = FastAPI(default_response_class=ORJSONResponse)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await close_redis()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+_IDENTITY = "identity"
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    request_id = str(uuid.uuid4())
+    request_id = os.urandom(16).hex()
     mb_ip = request.headers.get("X-Real-IP") or request.client.host
     logger_bound = logger.bind(request_id=request_id, mb_ip=mb_ip, method=request.method, path=request.url.path)
-    start_time = datetime.utcnow()
+    # Shared with the route handlers so they don't regenerate/rebind per request
+    request.state.request_id = request_id
+    request.state.mb_ip = mb_ip
+    request.state.logger = logger_bound
+    start_ns = perf_counter_ns()
     try:
         response = await call_next(request)
-        duration = (datetime.utcnow() - start_time).total_seconds() * 1000
+        duration = (perf_counter_ns() - start_ns) / 1_000_000
         logger_bound.info("Request completed", status_code=response.status_code, duration_ms=duration)
         return response
     except Exception as e:
@@ -31,75 +48,130 @@ async def log_requests(request: Request, call_next):
 @app.get("/health", response_model=HealthResponse)
 async def health():
     return HealthResponse(
-        time=datetime.utcnow().isoformat() + "Z",
+        time=datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
         version=APP_VERSION,
     )
 
+async def _read_body(request: Request) -> bytes:
+    """Read the body, rejecting with 413 as soon as it grows past MAX_BODY_SIZE."""
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            raise HTTPException(status_code=413, detail="Payload Too Large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def _gunzip(body: bytes) -> bytes:
+    """Inflate a gzip body, never producing more than MAX_BODY_SIZE + 1 bytes (zip-bomb guard)."""
+    out = []
+    size = 0
+    while body:  # gzip allows several concatenated members
+        decomp = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        try:
+            chunk = decomp.decompress(body, MAX_BODY_SIZE + 1 - size)
+        except zlib.error:
+            raise HTTPException(status_code=400, detail="Invalid gzip")
+        size += len(chunk)
+        if size > MAX_BODY_SIZE or decomp.unconsumed_tail:
+            raise HTTPException(status_code=413, detail="Payload Too Large")
+        if not decomp.eof:
+            raise HTTPException(status_code=400, detail="Invalid gzip")
+        out.append(chunk)
+        body = decomp.unused_data
+    return b"".join(out)
+
+def _group_item_errors(exc: ValidationError) -> Optional[Dict[int, str]]:
+    """Map item index -> error text; None if any error concerns the envelope itself."""
+    by_index: Dict[int, List[str]] = {}
+    for err in exc.errors():
+        loc = err["loc"]
+        if len(loc) < 2 or loc[0] != "items" or not isinstance(loc[1], int):
+            return None
+        field = ".".join(str(part) for part in loc[2:])
+        by_index.setdefault(loc[1], []).append(f"{field}: {err['msg']}" if field else err["msg"])
+    return {idx: "; ".join(msgs) for idx, msgs in by_index.items()}
+
+def _response_data(request: Request, client_request_id: Optional[str], received: int, accepted: int,
+                   errors: List[ErrorDetail]) -> dict:
+    """Fields shared by IngestResponse and TestResponse."""
+    return {
+        "status": "ok",
+        "schema_version": SCHEMA_VERSION,
+        "request_id": request.state.request_id,
+        "client_request_id": client_request_id,
+        "mb_ip": request.state.mb_ip,
+        "received": received,
+        "accepted": accepted,
+        "rejected": received - accepted,
+        "errors": errors[:20]
+    }
+
 async def process_request(request: Request, model: type, enqueue: bool = False):
-    content_encoding = request.headers.get("Content-Encoding", "identity").lower()
-    content_length_header = request.headers.get("Content-Length")
+    headers = request.headers
+    content_encoding = headers.get("content-encoding", _IDENTITY)
+    if content_encoding is not _IDENTITY:
+        content_encoding = content_encoding.lower()
+    content_length_header = headers.get("content-length")
     content_length = int(content_length_header) if content_length_header else None
-    body = await request.body()
-    if len(body) > MAX_BODY_SIZE:
+    # Declared oversize: reject before reading a byte (chunked bodies are still capped in _read_body)
+    if content_length is not None and content_length > MAX_BODY_SIZE:
         raise HTTPException(status_code=413, detail="Payload Too Large")
+    body = await _read_body(request)
     if content_encoding == "gzip":
-        try:
-            body = gzip.decompress(body)
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid gzip")
-        if len(body) > MAX_BODY_SIZE:
-            raise HTTPException(status_code=413, detail="Payload Too Large")
+        body = _gunzip(body)
         logger.debug("Decompressed gzip body", decompressed_size=len(body))
-    try:
-        data = orjson.loads(body) if body else {}
-    except orjson.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON")
-    request_id = str(uuid.uuid4())
-    mb_ip = request.headers.get("X-Real-IP") or request.client.host
-    client_request_id = data.get("client_request_id")
-    logger_bound = logger.bind(request_id=request_id, client_request_id=client_request_id, mb_ip=mb_ip)
+    request_id = request.state.request_id
+    mb_ip = request.state.mb_ip
     errors = []
-    received = len(data.get("items", []))
-    accepted = 0
-    valid_items = []
-    sent_at = None
     try:
-        # Validate envelope
-        parsed = model.model_validate(data)
-        sent_at = parsed.sent_at
-        client_request_id = parsed.client_request_id
-        # Per-item validation
-        if parsed.items:
-            for idx, raw_item in enumerate(parsed.items):
-                try:
-                    item = Item.model_validate(raw_item)
-                    valid_items.append(item)
-                    accepted += 1
-                except ValidationError as e:
-                    errors.append(ErrorDetail(index=idx, code="validation_error", detail=str(e)))
-                    if len(errors) >= 20:
-                        break
+        # JSON parsing and validation of envelope and items in one pydantic-core pass
+        parsed = model.model_validate_json(body or b"{}")
+        received = len(parsed.items) if parsed.items else 0
     except ValidationError as e:
-        # Envelope invalid
-        raise HTTPException(status_code=400, detail=str(e))
+        item_errors = _group_item_errors(e)
+        if item_errors is None:
+            if e.errors()[0]["type"] == "json_invalid":
+                raise HTTPException(status_code=400, detail="Invalid JSON")
+            # Envelope invalid
+            raise HTTPException(status_code=400, detail=str(e))
+        # Slow path: report the bad items, keep the rest
+        errors = [ErrorDetail(index=idx, code="validation_error", detail=detail) for idx, detail in item_errors.items()]
+        # Same parser as model_validate_json, so whatever it accepted (e.g. NaN) parses here too
+        data = from_json(body)
+        raw_items = data["items"]  # item-level errors imply a list here
+        received = len(raw_items)
+        # Items already validated here are passed as instances, which the envelope doesn't re-validate
+        good_items = ITEMS_ADAPTER.validate_python(
+            [raw for idx, raw in enumerate(raw_items) if idx not in item_errors]
+        )
+        try:
+            # Revalidate the envelope even when every item is bad, so TestRequest's ping/validate
+            # check still runs (an empty list is within its bounds). IngestRequest can't hold an
+            # empty list, and its envelope had no errors in the first pass
+            if good_items or model is TestRequest:
+                parsed = model.model_validate({**data, "items": good_items})
+            else:
+                parsed = None
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        client_request_id = data.get("client_request_id")
+    valid_items = (parsed.items or []) if parsed else []
+    sent_at = parsed.sent_at if parsed else None
+    if parsed:
+        client_request_id = parsed.client_request_id
+    accepted = len(valid_items)
     rejected = received - accepted
     if enqueue and valid_items and sent_at:
         try:
-            await enqueue_batch(request_id, client_request_id, mb_ip, sent_at, valid_items)
+            # Serialized by pydantic-core straight to bytes; no per-item model_dump in Python
+            items_json = ITEMS_ADAPTER.dump_json(valid_items)
+            await enqueue_batch(request_id, client_request_id, mb_ip, sent_at, items_json, accepted)
         except Exception:
             raise HTTPException(status_code=500, detail="Internal Server Error")
-    logger_bound.info("Processed request", received=received, accepted=accepted, rejected=rejected, errors_len=len(errors))
-    response_data = {
-        "status": "ok",
-        "schema_version": SCHEMA_VERSION,
-        "request_id": request_id,
-        "client_request_id": client_request_id,
-        "mb_ip": mb_ip,
-        "received": received,
-        "accepted": accepted,
-        "rejected": rejected,
-        "errors": errors[:20]
-    }
+    request.state.logger.info("Processed request", client_request_id=client_request_id, received=received, accepted=accepted, rejected=rejected, errors_len=len(errors))
+    response_data = _response_data(request, client_request_id, received, accepted, errors)
     return response_data, len(body) if content_encoding != "gzip" else content_length, content_encoding
 
 @app.post("/v1/ingest", response_model=IngestResponse, status_code=status.HTTP_202_ACCEPTED)
@@ -109,12 +181,17 @@ async def ingest(request: Request):
 
 @app.post("/v1/ingest/test", response_model=TestResponse)
 async def ingest_test(request: Request):
-    data, content_length, content_encoding = await process_request(request, TestRequest)
-    mode = "ping" if data["received"] == 0 else "validate"
-    data["mode"] = mode
+    headers = request.headers
+    # Empty ping: nothing to read, parse or validate
+    if headers.get("content-length") == "0":
+        data = _response_data(request, None, 0, 0, [])
+        content_length, content_encoding = 0, headers.get("content-encoding", _IDENTITY).lower()
+    else:
+        data, content_length, content_encoding = await process_request(request, TestRequest)
+    data["mode"] = "ping" if data["received"] == 0 else "validate"
     data["content_length"] = content_length if isinstance(content_length, int) else 0
     data["content_encoding"] = content_encoding
-    data["note"] = "dry-run; nothing enqueued or persisted"
+    # "note" is filled in from the TestResponse default
     return data
 
 if __name__ == "__main__":
@@ -1,29 +1,106 @@
-import json
 import os
 import socket
 from datetime import datetime
 import asyncio
 from typing import Optional
-from redis.asyncio import Redis
-from ingest.config import REDIS_URL, STREAM_KEY, CONSUMER_GROUP
+import orjson
+from redis.asyncio import BlockingConnectionPool, Redis
+from ingest.config import REDIS_URL, STREAM_KEY, CONSUMER_GROUP, ENQUEUE_COALESCE_MAX, ENQUEUE_COALESCE_WINDOW
 from ingest.logging_conf import logger
 
+# One client (and connection pool) per process, shared by every request
+_redis: Optional[Redis] = None
+_redis_lock = asyncio.Lock()
+
 async def get_redis() -> Redis:
-    return Redis.from_url(REDIS_URL, decode_responses=True)
+    global _redis
+    if _redis is None:
+        async with _redis_lock:
+            if _redis is None:
+                pool = BlockingConnectionPool.from_url(
+                    REDIS_URL, decode_responses=True, max_connections=64, health_check_interval=30
+                )
+                _redis = Redis.from_pool(pool)
+    return _redis
 
-async def enqueue_batch(request_id: str, client_request_id: Optional[str], mb_ip: str, sent_at: datetime, items: list) -> None:
-    redis = await get_redis()
-    items_json = json.dumps([item.model_dump(mode="json") for item in items])
+# (message, future) pairs waiting for the drainer to XADD them in one pipelined round-trip
+_pending: Optional[asyncio.Queue] = None
+_drainer: Optional[asyncio.Task] = None
+
+async def close_redis() -> None:
+    global _redis, _drainer
+    if _drainer is not None:
+        _drainer.cancel()
+        try:
+            await _drainer  # lets it fail the futures still waiting on it
+        except asyncio.CancelledError:
+            pass
+        _drainer = None
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+
+def _get_pending() -> asyncio.Queue:
+    global _pending, _drainer
+    if _drainer is None or _drainer.done():
+        _pending = asyncio.Queue()
+        _drainer = asyncio.create_task(_drain_pending(_pending))
+    return _pending
+
+async def _drain_pending(pending: asyncio.Queue) -> None:
+    batch = []
+    try:
+        while True:
+            batch = [await pending.get()]
+            await asyncio.sleep(ENQUEUE_COALESCE_WINDOW)
+            while len(batch) < ENQUEUE_COALESCE_MAX and not pending.empty():
+                batch.append(pending.get_nowait())
+            try:
+                redis = await get_redis()
+                async with redis.pipeline(transaction=False) as pipe:
+                    for message, _ in batch:
+                        pipe.xadd(STREAM_KEY, message)
+                    results = await pipe.execute(raise_on_error=False)
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():  # caller went away
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+    except asyncio.CancelledError:
+        # Shutdown: fail the in-flight flush and everything queued behind it, so
+        # enqueue_batch callers get an error (500) instead of waiting forever
+        while not pending.empty():
+            batch.append(pending.get_nowait())
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(RuntimeError("Enqueue drainer stopped"))
+        raise
+
+async def enqueue_batch(request_id: str, client_request_id: Optional[str], mb_ip: str, sent_at: datetime,
+                        items_json: bytes, item_count: int) -> None:
+    # Whole envelope as one JSON field; items_json is embedded as-is (no re-parse) and
+    # datetimes are encoded by orjson, with UTC written as "Z"
     message = {
-        "request_id": request_id,
-        "client_request_id": client_request_id or "",
-        "mb_ip": mb_ip,
-        "sent_at": sent_at.isoformat(),
-        "items_json": items_json
+        "data": orjson.dumps(
+            {
+                "request_id": request_id,
+                "client_request_id": client_request_id,
+                "mb_ip": mb_ip,
+                "sent_at": sent_at,
+                "items": orjson.Fragment(items_json),
+            },
+            option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z,
+        )
     }
+    future = asyncio.get_running_loop().create_future()
+    _get_pending().put_nowait((message, future))
     try:
-        await redis.xadd(STREAM_KEY, message)
-        logger.info("Enqueued batch", request_id=request_id, client_request_id=client_request_id, mb_ip=mb_ip, item_count=len(items))
+        await future
+        logger.info("Enqueued batch", request_id=request_id, client_request_id=client_request_id, mb_ip=mb_ip, item_count=item_count)
     except Exception as e:
         logger.error("Failed to enqueue batch", exc_info=e, request_id=request_id)
         raise
@@ -1,116 +1,82 @@
-from typing import List, Optional, Literal
-from pydantic import BaseModel, Field, field_validator, model_validator
-from datetime import datetime
-import re
-from ingest.config import SCHEMA_VERSION, ALLOWED_PROTOCOLS
+from datetime import datetime, timezone
+from typing import Annotated, List, Optional, Literal
+from pydantic import AfterValidator, AwareDatetime, BaseModel, ConfigDict, Field, TypeAdapter, field_validator, model_validator
+import string
+from ingest.config import SCHEMA_VERSION, MIN_ITEMS, MAX_ITEMS
+
+_CLIENT_REQUEST_ID_CHARS = frozenset(string.ascii_letters + string.digits + "._-")
+
+def _check_client_request_id(v: Optional[str]) -> Optional[str]:
+    if v and not _CLIENT_REQUEST_ID_CHARS.issuperset(v):
+        raise ValueError("Invalid charset: only [A-Za-z0-9._-]")
+    return v
+
+# Shared by both envelopes so the validator is defined (and built into the core schema) once
+ClientRequestId = Annotated[Optional[str], Field(max_length=128), AfterValidator(_check_client_request_id)]
+
+def _to_utc(v: datetime) -> datetime:
+    return v.astimezone(timezone.utc)
+
+# Normalised at the edge so queued items always carry "...Z" and the worker needn't convert
+UtcDatetime = Annotated[AwareDatetime, AfterValidator(_to_utc)]
 
 class Item(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     serial_number: str = Field(..., min_length=16, max_length=24)
     location: Optional[str] = None
-    protocol_type: str = Field(...)
+    protocol_type: Literal["rps", "pms", "css", "dss"]
     token: str = Field(..., min_length=1)
-    token_created_at: datetime = Field(...)
+    token_created_at: UtcDatetime = Field(...)
 
-    @field_validator("protocol_type")
+    @field_validator("protocol_type", mode="before")
     @classmethod
-    def validate_and_normalize_protocol(cls, v: str) -> str:
-        lower_v = v.lower()
-        if lower_v not in ALLOWED_PROTOCOLS:
-            raise ValueError(f"protocol_type must be one of: {','.join(ALLOWED_PROTOCOLS)}")
-        return lower_v
+    def normalize_protocol(cls, v):
+        return v.lower() if isinstance(v, str) else v
 
-    @field_validator("token_created_at", mode="before")
-    @classmethod
-    def validate_token_created_at(cls, v: str) -> datetime:
-        if isinstance(v, str):
-            v = v.replace("Z", "+00:00")  # Handle Z as UTC
-        try:
-            dt = datetime.fromisoformat(v)
-            if dt.tzinfo is None:
-                raise ValueError("Timezone required")
-            return dt
-        except ValueError as e:
-            raise ValueError(f"Invalid timezone-aware ISO8601: {e}")
+# Built once at import; validates a bare items array without an envelope model
+ITEMS_ADAPTER = TypeAdapter(List[Item])
 
 class IngestRequest(BaseModel):
-    schema_version: Literal[1] = Field(...)
-    sent_at: datetime = Field(...)
-    client_request_id: Optional[str] = Field(None, max_length=128)
-    items: List[dict] = Field(...)  # Raw dicts for per-item validation in endpoint
-
-    @field_validator("sent_at", mode="before")
-    @classmethod
-    def validate_sent_at(cls, v: str) -> datetime:
-        if isinstance(v, str):
-            v = v.replace("Z", "+00:00")  # Handle Z as UTC
-        try:
-            dt = datetime.fromisoformat(v)
-            if dt.tzinfo is None:
-                raise ValueError("Timezone required")
-            return dt
-        except ValueError as e:
-            raise ValueError(f"Invalid timezone-aware ISO8601: {e}")
-
-    @field_validator("client_request_id")
-    @classmethod
-    def validate_client_request_id(cls, v: Optional[str]) -> Optional[str]:
-        if v and not re.match(r"^[A-Za-z0-9._-]+$", v):
-            raise ValueError("Invalid charset: only [A-Za-z0-9._-]")
-        return v
+    model_config = ConfigDict(frozen=True)
 
-    @model_validator(mode="after")
-    def check_items_length(self):
-        if not (1 <= len(self.items) <= 100):
-            raise ValueError("items must have length 1..100")
-        return self
+    schema_version: Literal[1] = Field(...)
+    sent_at: AwareDatetime = Field(...)
+    client_request_id: ClientRequestId = None
+    items: Annotated[List[Item], Field(min_length=MIN_ITEMS, max_length=MAX_ITEMS)]
 
 class TestRequest(BaseModel):
-    schema_version: Optional[Literal[1]] = Field(None)
-    sent_at: Optional[datetime] = None
-    client_request_id: Optional[str] = Field(None, max_length=128)
-    items: Optional[List[dict]] = Field(None)  # Raw dicts for per-item validation
+    model_config = ConfigDict(frozen=True)
 
-    @field_validator("sent_at", mode="before")
-    @classmethod
-    def validate_sent_at(cls, v: Optional[str]) -> Optional[datetime]:
-        if v is None:
-            return None
-        v = v.replace("Z", "+00:00")
-        try:
-            dt = datetime.fromisoformat(v)
-            if dt.tzinfo is None:
-                raise ValueError("Timezone required")
-            return dt
-        except ValueError as e:
-            raise ValueError(f"Invalid timezone-aware ISO8601: {e}")
-
-    @field_validator("client_request_id")
-    @classmethod
-    def validate_client_request_id(cls, v: Optional[str]) -> Optional[str]:
-        if v and not re.match(r"^[A-Za-z0-9._-]+$", v):
-            raise ValueError("Invalid charset: only [A-Za-z0-9._-]")
-        return v
+    schema_version: Optional[Literal[1]] = Field(None)
+    sent_at: Optional[AwareDatetime] = None
+    client_request_id: ClientRequestId = None
+    items: Optional[Annotated[List[Item], Field(max_length=MAX_ITEMS)]] = None
 
     @model_validator(mode="after")
     def check_for_ping_or_validate(self):
         if self.items is not None:
             if self.schema_version is None or self.sent_at is None:
                 raise ValueError("schema_version and sent_at required when items present")
-            if len(self.items) > 100:
-                raise ValueError("items must have length <=100")
         return self
 
 class ErrorDetail(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     index: int
     code: str
     detail: str
 
 class HealthResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     status: str = "ok"
     time: str = Field(...)
     version: str = Field(...)
 
 class IngestResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     status: str = "ok"
     schema_version: int = SCHEMA_VERSION
     request_id: str
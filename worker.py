@@ -1,13 +1,24 @@
 import asyncio
+import operator
+import sys
 from datetime import datetime, timezone
-from typing import Dict, Any
+from typing import Any, Dict, List, Tuple
+import orjson
+from asyncpg.exceptions import TransactionRollbackError
 from tortoise import Model, fields, Tortoise
 from tortoise.exceptions import IntegrityError
 from tortoise.transactions import in_transaction
 from ingest.queue import consume_and_process
 from ingest.config import get_database_url
 from ingest.logging_conf import logger
-import json
+
+
+if sys.version_info >= (3, 11):
+    _fromisoformat = datetime.fromisoformat
+else:
+    def _fromisoformat(value: str) -> datetime:
+        # The producer writes UTC as "Z", which fromisoformat only accepts from 3.11 on
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
 
 
 def _to_aware_utc(dt: datetime | None) -> datetime | None:
@@ -16,6 +27,11 @@ def _to_aware_utc(dt: datetime | None) -> datetime | None:
     return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
 
 
+def _parse_aware_iso(value: str) -> datetime:
+    """Parse a queue timestamp; the API only enqueues tz-aware values, naive ones are taken as UTC."""
+    return _to_aware_utc(_fromisoformat(value))
+
+
 class Device(Model):
     id = fields.IntField(pk=True)
     serial_number = fields.CharField(max_length=24, unique=True)
@@ -49,15 +65,143 @@ async def init_tortoise():
         db_url=db_url,
         modules={"models": ["__main__"]}
     )
-    # No generate_schemas(); tables exist
+    # No generate_schemas(): the device_registry_* tables belong to the registry service and
+    # are migrated there; these models mirror only the columns the worker writes
+
+
+def _decode_message(msg: Dict[str, Any]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Return (envelope, items) for a stream entry.
+
+    Producers write the whole envelope as JSON in a single "data" field; entries
+    enqueued before that change carry flat fields plus an "items_json" string.
+    """
+    if "data" in msg:
+        envelope = orjson.loads(msg["data"])
+        return envelope, envelope["items"]
+    return msg, orjson.loads(msg["items_json"])
+
+
+# Set-based writes: a few statements per batch instead of get_or_create per item.
+# Rows are passed as parallel arrays and expanded with unnest().
+INSERT_DEVICES_SQL = """
+INSERT INTO device_registry_device (serial_number, name, location, created_at, updated_at)
+SELECT serial_number, '', location, now(), now()
+FROM unnest($1::varchar[], $2::text[]) AS t(serial_number, location)
+RETURNING id, serial_number
+"""
+
+# Must start with UPDATE: Tortoise then runs it via execute() and returns the row count
+UPDATE_DEVICE_LOCATIONS_SQL = """UPDATE device_registry_device AS d
+SET location = t.location, updated_at = now()
+FROM unnest($1::varchar[], $2::text[]) AS t(serial_number, location)
+WHERE d.serial_number = t.serial_number
+"""
+
+INSERT_PROTOCOLS_SQL = """
+INSERT INTO device_registry_deviceprotocol
+    (device_id, protocol_type, mb_ip, token, token_created_at, created_at, updated_at)
+SELECT device_id, protocol_type, $3, token, token_created_at, now(), now()
+FROM unnest($1::bigint[], $2::varchar[], $4::text[], $5::timestamptz[])
+    AS t(device_id, protocol_type, token, token_created_at)
+"""
+
+# The token_created_at guard re-checks in the DB what the prefetch saw, for concurrent writers
+UPDATE_PROTOCOLS_SQL = """UPDATE device_registry_deviceprotocol AS p
+SET mb_ip = $3, token = t.token, token_created_at = t.token_created_at, updated_at = now()
+FROM unnest($1::bigint[], $2::varchar[], $4::text[], $5::timestamptz[])
+    AS t(device_id, protocol_type, token, token_created_at)
+WHERE p.device_id = t.device_id AND p.protocol_type = t.protocol_type
+  AND (p.token_created_at IS NULL OR p.token_created_at < t.token_created_at)
+"""
+
+
+# One C call per item instead of five subscripts
+_item_fields = operator.itemgetter("serial_number", "location", "protocol_type", "token", "token_created_at")
+
+
+async def _write_batch(locations: Dict[str, str | None], protocols: Dict[Tuple[str, str], Tuple[str, datetime]],
+                       mb_ip: str) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """Upsert a collapsed batch in one transaction; returns (device_stats, protocol_stats)."""
+    device_stats = {"created": 0, "updated": 0, "noop": 0}
+    protocol_stats = {"created": 0, "updated": 0, "noop": 0}
+    # Sorted so concurrent workers mostly lock rows in the same order; the planner may still
+    # reorder the UPDATE ... FROM unnest() joins, so deadlocks remain possible and are retried
+    serials = sorted(locations)
+    protocol_keys = sorted(protocols)
+    async with in_transaction() as conn:
+        # Most serials already exist: one SELECT settles them, and only the rest are inserted.
+        # A concurrent insert raises IntegrityError here and the caller replays the batch.
+        device_ids: Dict[str, int] = {}
+        moved: Dict[str, str] = {}
+        for device_id, serial_number, current in await Device.filter(serial_number__in=serials).values_list(
+                "id", "serial_number", "location"):
+            device_ids[serial_number] = device_id
+            location = locations[serial_number]
+            if location and location != current:
+                moved[serial_number] = location
+        existing_ids = list(device_ids.values())
+        missing = [s for s in serials if s not in device_ids]
+        if missing:
+            _, rows = await conn.execute_query(INSERT_DEVICES_SQL, [missing, [locations[s] for s in missing]])
+            device_ids.update((row["serial_number"], row["id"]) for row in rows)
+            device_stats["created"] = len(rows)
+        if moved:
+            moved_serials = sorted(moved)
+            device_stats["updated"], _ = await conn.execute_query(
+                UPDATE_DEVICE_LOCATIONS_SQL, [moved_serials, [moved[s] for s in moved_serials]])
+        device_stats["noop"] = len(serials) - device_stats["created"] - device_stats["updated"]
+
+        # Same for protocols: rows already holding an equal or newer token are settled here,
+        # new ones are inserted and newer ones go through the guarded UPDATE
+        stored: Dict[Tuple[int, str], datetime | None] = {}
+        if existing_ids:
+            for device_id, protocol_type, token_created_at in await DeviceProtocol.filter(
+                    device_id__in=existing_ids).values_list("device_id", "protocol_type", "token_created_at"):
+                stored[device_id, protocol_type] = token_created_at
+        inserts = []
+        updates = []
+        for serial_number, protocol_type in protocol_keys:
+            device_id = device_ids[serial_number]
+            token, token_created_at = protocols[serial_number, protocol_type]
+            if (device_id, protocol_type) not in stored:
+                inserts.append((device_id, protocol_type, token, token_created_at))
+                continue
+            current = _to_aware_utc(stored[device_id, protocol_type])
+            if current is None or token_created_at > current:
+                updates.append((device_id, protocol_type, token, token_created_at))
+        if inserts:
+            device_col, type_col, token_col, created_col = map(list, zip(*inserts))
+            await conn.execute_query(INSERT_PROTOCOLS_SQL, [device_col, type_col, mb_ip, token_col, created_col])
+            protocol_stats["created"] = len(inserts)
+        if updates:
+            device_col, type_col, token_col, created_col = map(list, zip(*updates))
+            protocol_stats["updated"], _ = await conn.execute_query(
+                UPDATE_PROTOCOLS_SQL, [device_col, type_col, mb_ip, token_col, created_col])
+        protocol_stats["noop"] = len(protocol_keys) - protocol_stats["created"] - protocol_stats["updated"]
+    return device_stats, protocol_stats
+
+
+# Lost insert race, deadlock or serialization failure: the transaction rolled back and
+# replaying it usually succeeds
+_RETRYABLE_ERRORS = (IntegrityError, TransactionRollbackError)
+
+
+async def _write_with_retry(locations: Dict[str, str | None],
+                            protocols: Dict[Tuple[str, str], Tuple[str, datetime]],
+                            mb_ip: str, logger_bound) -> Tuple[Dict[str, int], Dict[str, int]]:
+    try:
+        return await _write_batch(locations, protocols, mb_ip)
+    except _RETRYABLE_ERRORS as e:
+        logger_bound.warning("Write conflict; retrying", error=str(e))
+        await asyncio.sleep(0.1)  # Short backoff for race
+    return await _write_batch(locations, protocols, mb_ip)
 
 
 async def process_batch(msg: Dict[str, Any]):
-    request_id = msg["request_id"]
-    client_request_id = msg.get("client_request_id") or None
-    mb_ip = msg["mb_ip"]
-    sent_at = datetime.fromisoformat(msg["sent_at"])
-    items = json.loads(msg["items_json"])
+    envelope, items = _decode_message(msg)
+    request_id = envelope["request_id"]
+    client_request_id = envelope.get("client_request_id") or None
+    mb_ip = envelope["mb_ip"]
     logger_bound = logger.bind(request_id=request_id, client_request_id=client_request_id, mb_ip=mb_ip,
                                item_count=len(items))
 
@@ -65,81 +209,59 @@ async def process_batch(msg: Dict[str, Any]):
     protocol_stats = {"created": 0, "updated": 0, "noop": 0}
     errors = []
 
+    # Collapse the batch to the end state per-item processing would reach:
+    # last non-empty location per device, newest token per (device, protocol)
+    locations: Dict[str, str | None] = {}
+    protocols: Dict[Tuple[str, str], Tuple[str, datetime]] = {}
+    # (idx, serial_number, location, protocol_type, token, token_created_at) per parsed item,
+    # kept for the one-at-a-time fallback
+    parsed: List[Tuple[int, str, str | None, str, str, datetime]] = []
+    # Bound to locals for the loop (LOAD_FAST instead of global lookups)
+    item_fields = _item_fields
+    parse_aware_iso = _parse_aware_iso
     for idx, item in enumerate(items):
-        serial_number = item["serial_number"]
-        location = item["location"] if item["location"] else None
-        protocol_type = item["protocol_type"]
-        token = item["token"]
-        token_created_at = datetime.fromisoformat(item["token_created_at"]).astimezone(timezone.utc)
-
         try:
-            async with in_transaction():
-                device, created = await Device.get_or_create(serial_number=serial_number,
-                                                             defaults={"name": "", "location": location})
-                if created:
-                    device_stats["created"] += 1
-                elif location and device.location != location:
-                    device.location = location
-                    await device.save(update_fields=["location"])
-                    device_stats["updated"] += 1
-                else:
-                    device_stats["noop"] += 1
-
-                protocol, created = await DeviceProtocol.get_or_create(
-                    device=device, protocol_type=protocol_type,
-                    defaults={
-                        "mb_ip": mb_ip,
-                        "token": token,
-                        "token_created_at": token_created_at
-                    }
-                )
-                if created:
-                    protocol_stats["created"] += 1
-                else:
-                    existing = _to_aware_utc(protocol.token_created_at)
-                    if existing is None or token_created_at > existing:
-                        protocol.mb_ip = mb_ip
-                        protocol.token = token
-                        protocol.token_created_at = token_created_at
-                        await protocol.save(update_fields=["mb_ip", "token", "token_created_at"])
-                        protocol_stats["updated"] += 1
-                    else:
-                        protocol_stats["noop"] += 1
-        except IntegrityError as e:
-            logger_bound.warning("Integrity error; retrying", exc_info=e, idx=idx)
-            await asyncio.sleep(0.1)  # Short backoff for race
-            try:
-                async with in_transaction():
-                    device = await Device.get(serial_number=serial_number)
-                    if location and device.location != location:
-                        device.location = location
-                        await device.save(update_fields=["location"])
-                        device_stats["updated"] += 1
-                    else:
-                        device_stats["noop"] += 1
-
-                    protocol = await DeviceProtocol.get(device=device, protocol_type=protocol_type)
-                    existing = _to_aware_utc(protocol.token_created_at)
-                    if existing is None or token_created_at > existing:
-                        protocol.mb_ip = mb_ip
-                        protocol.token = token
-                        protocol.token_created_at = token_created_at
-                        await protocol.save(update_fields=["mb_ip", "token", "token_created_at"])
-                        protocol_stats["updated"] += 1
-                    else:
-                        protocol_stats["noop"] += 1
-            except Exception as retry_e:
-                errors.append({"idx": idx, "error": str(retry_e)})
-                logger_bound.error("Retry failed", exc_info=retry_e, idx=idx)
+            serial_number, location, protocol_type, token, token_created_at = item_fields(item)
+            location = location or None
+            key = (serial_number, protocol_type)
+            token_created_at = parse_aware_iso(token_created_at)
         except Exception as e:
             errors.append({"idx": idx, "error": str(e)})
             logger_bound.error("Item processing failed", exc_info=e, idx=idx)
+            continue
+        if location or serial_number not in locations:
+            locations[serial_number] = location
+        current = protocols.get(key)
+        if current is None or token_created_at > current[1]:
+            protocols[key] = (token, token_created_at)
+        parsed.append((idx, serial_number, location, protocol_type, token, token_created_at))
+
+    if locations:
+        try:
+            device_stats, protocol_stats = await _write_with_retry(locations, protocols, mb_ip, logger_bound)
+        except Exception as e:
+            # One bad row (e.g. a NUL byte Postgres rejects) fails the whole statement; replay the
+            # items one at a time, in order, so only the bad ones are lost
+            logger_bound.warning("Batch write failed; writing items one at a time", error=str(e))
+            for idx, serial_number, location, protocol_type, token, token_created_at in parsed:
+                try:
+                    item_devices, item_protocols = await _write_with_retry(
+                        {serial_number: location}, {(serial_number, protocol_type): (token, token_created_at)},
+                        mb_ip, logger_bound)
+                except Exception as item_e:
+                    errors.append({"idx": idx, "error": str(item_e)})
+                    logger_bound.error("Item processing failed", exc_info=item_e, idx=idx)
+                    continue
+                for stats, item_stats in ((device_stats, item_devices), (protocol_stats, item_protocols)):
+                    for outcome, count in item_stats.items():
+                        stats[outcome] += count
 
     logger_bound.info(
         "Batch processed",
         device_stats=device_stats,
         protocol_stats=protocol_stats,
-        errors_summary=[e["error"] for e in errors] if errors else None
+        # Distinct messages only; several items often fail for the same reason
+        errors_summary=list(dict.fromkeys(e["error"] for e in errors)) if errors else None
     )
 
 